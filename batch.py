@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Find and replace across many dialogue files at once.
+
+Replacements are applied to node fields (text, condition, script, speakerName,
+portrait) directly in the xml source: only the text of the affected elements
+is rewritten and everything else is left byte for byte as it was, so a preview
+diff shows just the edited values and unchanged files are never written.
+
+    python batch.py -e OLD NEW [--fields condition,script] [--word] PATH...
+    python batch.py -e OLD NEW ... --apply PATH...
+
+PATH is a dialogue xml file, a directory of them or a scripts.aod archive.
+Without --apply the changes are only shown as a diff.
+"""
+import sys
+import os
+import re
+from xml.sax.saxutils import escape
+
+from dialogue import iterateArchive
+
+# which elements hold which field, as (parent tag, tag); same names as in the editor
+FIELDS = {
+    'text':        {('dlgPart', 'npc_text'), ('dlgAnsw', 'text')},
+    'condition':   {('dlgAnsw', 'checkOnAppear'), ('checksOnClick', 'string'), ('conditions', 'string')},
+    'script':      {('onLoadScripts', 'string'), ('scriptsOnClick', 'string')},
+    'speakerName': {('dlgPart', 'speaker_name'), ('header', 'def_speaker_name')},
+    'portrait':    {('dlgPart', 'portrait'), ('header', 'def_portrait')},
+}
+_fieldByElement = {key: field for (field, keys) in FIELDS.items() for key in keys}
+
+_markup = re.compile(r'<!--.*?-->|<\?.*?\?>|<!\[CDATA\[.*?\]\]>|<!.*?>|<(/?)([^\s/>]+)[^>]*?(/?)>', re.S)
+_reference = re.compile(r'&(#[0-9]+|#x[0-9a-fA-F]+|amp|lt|gt|quot|apos);')
+_entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+def _unescape(text):
+    "`text` with its xml entity and character references (&amp;, &#233;, &#xE9;) decoded."
+    def decode(match):
+        ref = match.group(1)
+        if not ref.startswith('#'):
+            return _entities[ref]
+        try:
+            return chr(int(ref[2:], 16) if ref.startswith('#x') else int(ref[1:]))
+        except (ValueError, OverflowError):
+            raise ValueError('bad character reference &%s;' % ref)
+    return _reference.sub(decode, text)
+
+class Replacement:
+    """One find-and-replace rule.
+
+`pattern` is a regular expression, or plain text if `literal` is set; `word`
+only matches it as a whole word and `whole` only replaces values that match it
+entirely (e.g. renaming one speaker without touching longer names).  Only the
+given `fields` are affected.  The pattern is compiled once, up front."""
+    def __init__(self, pattern, replacement, fields=tuple(FIELDS), literal=False, word=False, whole=False,
+                 ignoreCase=False):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError('unknown field(s): %s' % ', '.join(sorted(unknown)))
+        if literal:
+            pattern = re.escape(pattern)
+            replacement = replacement.replace('\\', '\\\\')
+        if word:
+            pattern = r'\b(?:%s)\b' % pattern
+        self.regex = re.compile(pattern, re.IGNORECASE if ignoreCase else 0)
+        self.replacement = replacement
+        self.fields = frozenset(fields)
+        self.whole = whole
+    def apply(self, field, value):
+        "`value` of `field` with this rule applied."
+        if field not in self.fields:
+            return value
+        if self.whole:
+            match = self.regex.fullmatch(value)
+            return match.expand(self.replacement) if match else value
+        return self.regex.sub(self.replacement, value)
+
+class FileEdit:
+    """Result of running the replacements over one dialogue file.  `name` is where
+it is read from and written to, `label` its path relative to the input it was
+found in.  `changes` lists (line, field, old value, new value) for every edited
+element and `spans` the lines it covers, as (first line, line count before,
+line count after)."""
+    def __init__(self, source, name, label, original, edited, changes, spans):
+        self.source = source
+        self.name = name
+        self.label = label
+        self.original = original
+        self.edited = edited
+        self.changes = changes
+        self.spans = spans
+    def diff(self, context=3):
+        """The change as a unified diff.  The text between the edited spans is known
+to be unchanged, so hunks are built from the spans alone, without any matching."""
+        a = _lines(self.original)
+        b = _lines(self.edited)
+        # [start, end in a, start, end in b], 0-based and end exclusive; values
+        # sharing a line go into one block
+        blocks = []
+        shift = 0
+        for (line, before, after) in self.spans:
+            start = line - 1
+            if blocks and start < blocks[-1][1]:
+                block = blocks[-1]
+                block[1] = max(block[1], start + before)
+            else:
+                block = [start, start + before, start + shift, None]
+                blocks.append(block)
+            shift += after - before
+            block[3] = block[1] + shift
+        # a multi-line value may keep some of its lines; blocks that then touch are
+        # shown as one
+        trimmed = []
+        for block in blocks:
+            while block[0] < block[1] and block[2] < block[3] and a[block[0]] == b[block[2]]:
+                block[0] += 1
+                block[2] += 1
+            while block[0] < block[1] and block[2] < block[3] and a[block[1] - 1] == b[block[3] - 1]:
+                block[1] -= 1
+                block[3] -= 1
+            if trimmed and trimmed[-1][1] == block[0]:
+                trimmed[-1][1], trimmed[-1][3] = block[1], block[3]
+            else:
+                trimmed.append(block)
+        blocks = trimmed
+        out = ['--- a/%s\n' % self.label, '+++ b/%s\n' % self.label]
+        i = 0
+        while i < len(blocks):
+            j = i
+            while j + 1 < len(blocks) and blocks[j + 1][0] - blocks[j][1] <= 2 * context:
+                j += 1
+            aStart = max(0, blocks[i][0] - context)
+            aEnd = min(len(a), blocks[j][1] + context)
+            bStart = aStart + blocks[i][2] - blocks[i][0]
+            bEnd = aEnd + blocks[j][3] - blocks[j][1]
+            out.append('@@ -%s +%s @@\n' % (_hunkRange(aStart, aEnd), _hunkRange(bStart, bEnd)))
+            at = aStart
+            for (a1, a2, b1, b2) in blocks[i:j + 1]:
+                out.extend(' ' + line for line in a[at:a1])
+                out.extend('-' + line for line in a[a1:a2])
+                out.extend('+' + line for line in b[b1:b2])
+                at = a2
+            out.extend(' ' + line for line in a[at:aEnd])
+            i = j + 1
+        return ''.join(out)
+
+def _lines(text):
+    "`text` split after each \\n (and only there, unlike str.splitlines)."
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    return lines if lines[-1] else lines[:-1]
+
+def _hunkRange(start, stop):
+    "Line range of a unified diff hunk header."
+    if stop - start == 1:
+        return '%d' % (start + 1)
+    return '%d,%d' % (start + 1 if stop > start else start, stop - start)
+
+def rewriteDialogue(text, replacements):
+    """Apply `replacements` to the field elements in the xml source `text`.
+Returns the new source and the lists of changes and spans (see `FileEdit`)."""
+    out = []
+    changes = []
+    spans = []
+    newline = '\r\n' if '\r\n' in text else '\n' # what edited values are written with
+    done = 0 # end of the part of `text` already copied to `out`
+    line, lineAt = 1, 0
+    stack = [] # [tag, end of its start tag, has child elements]
+    for match in _markup.finditer(text):
+        closing, tag, selfClosing = match.groups()
+        if tag is None:
+            if match.group().startswith('<![CDATA[') and stack:
+                stack[-1][2] = True # leave CDATA content alone
+            continue
+        if not closing:
+            if stack:
+                stack[-1][2] = True
+            if not selfClosing:
+                stack.append([tag, match.end(), False])
+            continue
+        if not stack or stack[-1][0] != tag:
+            raise ValueError('unbalanced </%s> at offset %d' % (tag, match.start()))
+        _, start, hasChildren = stack.pop()
+        field = _fieldByElement.get((stack[-1][0] if stack else None, tag))
+        if field is None or hasChildren:
+            continue
+        # line ends as an xml parser sees them; only &#13; stays a CR
+        value = _unescape(text[start:match.start()].replace('\r\n', '\n').replace('\r', '\n'))
+        edited = value
+        for replacement in replacements:
+            edited = replacement.apply(field, edited)
+        if edited == value:
+            continue
+        line += text.count('\n', lineAt, start)
+        lineAt = start
+        escaped = escape(edited, {'\r': '&#13;'}).replace('\n', newline)
+        changes.append((line, field, value, edited))
+        spans.append((line, text.count('\n', start, match.start()) + 1, escaped.count('\n') + 1))
+        out.append(text[done:start])
+        out.append(escaped)
+        done = match.start()
+    out.append(text[done:])
+    return ''.join(out), changes, spans
+
+def _edit(job):
+    "Worker: (source, name, label, data, replacements) -> FileEdit or an error string."
+    source, name, label, data, replacements = job
+    try:
+        original = data.decode('utf-8')
+        edited, changes, spans = rewriteDialogue(original, replacements)
+    except (UnicodeDecodeError, ValueError) as e:
+        return '%s: %s' % (name, e)
+    if not changes:
+        return None
+    return FileEdit(source, name, label, original, edited, changes, spans)
+
+def iterateSources(paths):
+    """Yield (source, name, label, bytes) for dialogue files, directories and
+archives; see `FileEdit`."""
+    for path in paths:
+        if os.path.isfile(path) and path.lower().endswith('.xml'):
+            with open(path, 'rb') as f:
+                yield None, path, os.path.basename(path), f.read()
+        elif os.path.isdir(path):
+            for (name, data) in iterateArchive(path):
+                yield None, name, os.path.relpath(name, path).replace(os.sep, '/'), data
+        else:
+            for (name, data) in iterateArchive(path):
+                yield path, name, name, data
+
+def batchEdit(paths, replacements, workers=None):
+    """Run `replacements` over every dialogue in `paths`, in parallel processes.
+Nothing is written.  Returns (list of `FileEdit` for the files that would
+change, list of error messages for files that couldn't be processed)."""
+    jobs = [(source, name, label, data, replacements) for (source, name, label, data) in iterateSources(paths)]
+    if workers == 1 or len(jobs) < 8:
+        results = list(map(_edit, jobs))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_edit, jobs, chunksize=max(1, len(jobs) // 64)))
+    edits = [r for r in results if isinstance(r, FileEdit)]
+    errors = [r for r in results if isinstance(r, str)]
+    return edits, errors
+
+def applyEdits(edits):
+    """Write the edited files.  Plain files are replaced one by one; an archive is
+rewritten once, with its other entries copied over unchanged."""
+    byArchive = {}
+    for edit in edits:
+        if edit.source is None:
+            with open(edit.name + '.tmp', 'wb') as f:
+                f.write(edit.edited.encode('utf-8'))
+            os.replace(edit.name + '.tmp', edit.name)
+        else:
+            byArchive.setdefault(edit.source, {})[edit.name] = edit.edited.encode('utf-8')
+    import zipfile
+    for (archivePath, replaced) in byArchive.items():
+        with zipfile.ZipFile(archivePath) as old, zipfile.ZipFile(archivePath + '.tmp', 'w') as new:
+            for info in old.infolist():
+                new.writestr(info, replaced[info.filename] if info.filename in replaced else old.read(info.filename))
+        os.replace(archivePath + '.tmp', archivePath)
+
+def main(argv):
+    "Command line: preview or apply a batch edit."
+    import argparse
+    parser = argparse.ArgumentParser(description='Find and replace across Age of Decadence dialogue files.')
+    parser.add_argument('-e', dest='rules', nargs=2, action='append', required=True, metavar=('PATTERN', 'REPLACEMENT'),
+                        help='regular expression and its replacement (can be repeated)')
+    parser.add_argument('--fields', default=','.join(FIELDS),
+                        help='comma-separated fields to edit (default: all of %(default)s)')
+    parser.add_argument('--literal', action='store_true', help='patterns are plain text, not regular expressions')
+    parser.add_argument('--word', action='store_true', help='only match whole words')
+    parser.add_argument('--whole', action='store_true', help='only replace values that match entirely')
+    parser.add_argument('-i', '--ignore-case', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--apply', action='store_true', help='write the changes instead of showing them')
+    parser.add_argument('paths', nargs='+', help='dialogue xml files, directories or scripts.aod archives')
+    args = parser.parse_args(argv)
+    try:
+        replacements = [Replacement(pattern, replacement, args.fields.split(','), args.literal, args.word,
+                                    args.whole, args.ignore_case)
+                        for (pattern, replacement) in args.rules]
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+    edits, errors = batchEdit(args.paths, replacements, args.jobs)
+    for error in errors:
+        print(error, file=sys.stderr)
+    if args.apply:
+        applyEdits(edits)
+    else:
+        for edit in edits:
+            sys.stdout.write(edit.diff())
+    print('%d change(s) in %d file(s)%s' % (sum(len(e.changes) for e in edits), len(edits),
+                                            '' if args.apply else ' (preview; use --apply to write)'),
+          file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
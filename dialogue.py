@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Age of Decadence dialogue files without the GUI: reading them, keeping track
+of node UIDs and laying out the dialogue graph.  Nothing here imports Qt.
+
+Run directly to check dialogue files for errors and duplicate UIDs:
+
+    python dialogue.py [--archive scripts.aod] dialogue.xml...
+"""
+import sys
+import os
+import io
+import bisect
+from collections import deque
+
+class BadXmlException(BaseException):
+    def __init__(self, message='Not a dialogue file', line=None):
+        super().__init__(message if line is None else 'line %d: %s' % (line, message))
+        self.line = line
+
+# class MalformedDialogue(BaseException):
+#     def __init__(self):
+#         super().__init__()
+
+class DialogueAnswer:
+    "Plain data of one <dlgAnsw>, as read by `readDialogue`."
+    def __init__(self, line):
+        self.line = line
+        self.text = ''
+        self.condition = ''
+        self.defaultLink = None
+        self.checks = []
+        self.links = []
+        self.scripts = []
+    def allLinks(self):
+        "(UID, condition) pairs, the default link first with condition None."
+        return [(self.defaultLink, None)] + list(zip(self.links, self.checks))
+
+class DialoguePart:
+    "Plain data of one <dlgPart>, as read by `readDialogue`."
+    def __init__(self, line):
+        self.line = line
+        self.UID = None
+        self.text = ''
+        self.portrait = ''
+        self.speakerName = ''
+        self.scripts = []
+        self.answers = []
+
+class Dialogue:
+    "Plain data of a whole dialogue file, as read by `readDialogue`."
+    def __init__(self):
+        self.dialogueName = ''
+        self.defaultLink = ''
+        self.defaultSpeakerName = ''
+        self.defaultPortrait = ''
+        self.conditions = []
+        self.links = []
+        self.roots = []
+        self.parts = []
+
+def readDialogue(source):
+    """Read a dialogue xml file (a filename or a binary file object) in a single
+streaming pass.  Elements are handled as soon as they are complete and then
+dropped, so the whole document is never held in memory.  Raises
+`BadXmlException` with the offending line number for malformed input."""
+    import xml.etree.ElementTree as ET
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return readDialogue(f)
+    dialogue = Dialogue()
+    part = None
+    answer = None
+    sawParts = False
+    open_ = [] # elements started but not yet ended
+    line = 0
+    linkLines = {} # header link element -> the lines its UIDs were on, for errors
+
+    def toInt(text, what, at=None):
+        try:
+            return int(text)
+        except (TypeError, ValueError):
+            raise BadXmlException('%s is not a number: %r' % (what, text), line if at is None else at)
+    def setAttr(name):
+        return lambda obj, text: setattr(obj, name, text)
+    def appendTo(name):
+        return lambda obj, text: getattr(obj, name).append(text)
+    def headerLink(tag, action):
+        def handle(obj, text):
+            action(obj, text)
+            linkLines.setdefault(tag, []).append(line)
+        return handle
+    # (parent tag, tag) -> (which object, what to do with the element text)
+    handlers = {
+        ('header', 'dlg_name'):         ('header', setAttr('dialogueName')),
+        ('header', 'def_link'):         ('header', headerLink('def_link', setAttr('defaultLink'))),
+        ('header', 'def_speaker_name'): ('header', setAttr('defaultSpeakerName')),
+        ('header', 'def_portrait'):     ('header', setAttr('defaultPortrait')),
+        ('conditions', 'string'):       ('header', appendTo('conditions')),
+        ('links', 'int'):               ('header', headerLink('int', appendTo('links'))),
+        ('dlgPart', 'UID'):             ('part', lambda p, text: setattr(p, 'UID', toInt(text, 'UID'))),
+        ('dlgPart', 'npc_text'):        ('part', setAttr('text')),
+        ('dlgPart', 'portrait'):        ('part', setAttr('portrait')),
+        ('dlgPart', 'speaker_name'):    ('part', setAttr('speakerName')),
+        ('onLoadScripts', 'string'):    ('part', appendTo('scripts')),
+        ('dlgAnsw', 'text'):            ('answer', setAttr('text')),
+        ('dlgAnsw', 'checkOnAppear'):   ('answer', setAttr('condition')),
+        ('dlgAnsw', 'def_link'):        ('answer', lambda a, text: setattr(a, 'defaultLink', toInt(text, 'def_link'))),
+        ('checksOnClick', 'string'):    ('answer', appendTo('checks')),
+        ('linksOnClick', 'int'):        ('answer', lambda a, text: a.links.append(toInt(text, 'link UID'))),
+        ('scriptsOnClick', 'string'):   ('answer', appendTo('scripts')),
+    }
+
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    try:
+        # feeding line by line is what lets us report line numbers
+        for line, data in enumerate(source, 1):
+            parser.feed(data)
+            for (event, element) in parser.read_events():
+                if event == 'start':
+                    tag = element.tag
+                    if tag == 'dlgPart':
+                        part = DialoguePart(line)
+                    elif tag == 'dlgAnsw':
+                        if part is None:
+                            raise BadXmlException('<dlgAnsw> outside of a <dlgPart>', line)
+                        answer = DialogueAnswer(line)
+                        part.answers.append(answer)
+                    elif tag == 'parts':
+                        sawParts = True
+                    open_.append(element)
+                    continue
+                tag = open_.pop().tag
+                handler = handlers.get((open_[-1].tag if open_ else None, tag))
+                if handler:
+                    target, action = handler
+                    obj = dialogue if target == 'header' else part if target == 'part' else answer
+                    if obj is not None:
+                        action(obj, element.text or '')
+                elif tag == 'dlgAnsw':
+                    if answer.defaultLink is None:
+                        raise BadXmlException('answer "%s" has no <def_link>' % answer.text, answer.line)
+                    if len(answer.checks) != len(answer.links):
+                        raise BadXmlException('answer "%s" has %d <checksOnClick> but %d <linksOnClick>' %
+                                              (answer.text, len(answer.checks), len(answer.links)), answer.line)
+                    answer = None
+                elif tag == 'dlgPart':
+                    if part.UID is None:
+                        raise BadXmlException('<dlgPart> without a <UID>', part.line)
+                    dialogue.parts.append(part)
+                    part = None
+                if open_ and len(open_) <= 2:
+                    # done with a <header> or a <dlgPart>: drop it from the tree
+                    open_[-1].clear()
+        parser.close()
+    except ET.ParseError as e:
+        line, column = e.position
+        raise BadXmlException('%s (column %d)' % (str(e).split(':')[0], column), line)
+    if not sawParts:
+        raise BadXmlException('no <parts> element')
+    roots = [(dialogue.defaultLink, linkLines['def_link'][-1])] if dialogue.defaultLink else []
+    roots += zip(dialogue.links, linkLines.get('int', []))
+    dialogue.roots = [toInt(uid, 'header link', uidLine) for (uid, uidLine) in roots]
+    known = set(part.UID for part in dialogue.parts)
+    for part in dialogue.parts:
+        for answer in part.answers:
+            for (uid, _) in answer.allLinks():
+                if uid not in known:
+                    raise BadXmlException('answer "%s" links to unknown UID %d' % (answer.text, uid), answer.line)
+    return dialogue
+
+class UIDAllocator:
+    """Set of used node UIDs, kept as sorted disjoint intervals [start, end].
+
+`shared` is an optional second allocator (e.g. one holding the UIDs of every
+other dialogue in the archive) whose UIDs are also considered taken.  Lookups
+and allocation are O(log n) bisections over the interval starts."""
+    def __init__(self, uids=(), shared=None):
+        self.starts = []
+        self.ends = []
+        self.shared = shared
+        for uid in uids:
+            self.reserve(uid)
+    def _find(self, uid):
+        "Index of the interval containing `uid`, or -1."
+        i = bisect.bisect_right(self.starts, uid) - 1
+        if i >= 0 and self.ends[i] >= uid:
+            return i
+        return -1
+    def __contains__(self, uid):
+        return self._find(uid) != -1 or (self.shared is not None and uid in self.shared)
+    def __len__(self):
+        return sum(end - start + 1 for (start, end) in zip(self.starts, self.ends))
+    def reserve(self, uid):
+        "Mark `uid` as used.  Returns False if it was used already (a collision)."
+        uid = int(uid)
+        i = bisect.bisect_right(self.starts, uid) - 1
+        if i >= 0 and self.ends[i] >= uid:
+            return False
+        joinsLeft = i >= 0 and self.ends[i] == uid - 1
+        joinsRight = i + 1 < len(self.starts) and self.starts[i + 1] == uid + 1
+        if joinsLeft and joinsRight:
+            self.ends[i] = self.ends[i + 1]
+            del self.starts[i + 1]
+            del self.ends[i + 1]
+        elif joinsLeft:
+            self.ends[i] = uid
+        elif joinsRight:
+            self.starts[i + 1] = uid
+        else:
+            self.starts.insert(i + 1, uid)
+            self.ends.insert(i + 1, uid)
+        return True
+    def release(self, uid):
+        "Mark `uid` as free again.  Does nothing if it wasn't used."
+        uid = int(uid)
+        i = self._find(uid)
+        if i == -1:
+            return
+        start, end = self.starts[i], self.ends[i]
+        if start == end:
+            del self.starts[i]
+            del self.ends[i]
+        elif uid == start:
+            self.starts[i] = uid + 1
+        elif uid == end:
+            self.ends[i] = uid - 1
+        else:
+            self.ends[i] = uid - 1
+            self.starts.insert(i + 1, uid + 1)
+            self.ends.insert(i + 1, end)
+    def lowest(self):
+        "The smallest UID used here (not counting `shared`), or None."
+        return self.starts[0] if self.starts else None
+    def highest(self):
+        "The largest UID used here (not counting `shared`), or None."
+        return self.ends[-1] if self.ends else None
+    def nextFree(self, uid=1):
+        "The smallest UID >= `uid` that is used neither here nor in `shared`."
+        while True:
+            i = self._find(uid)
+            if i != -1:
+                uid = self.ends[i] + 1
+            if self.shared is None or uid not in self.shared:
+                return uid
+            uid = self.shared.nextFree(uid)
+    def allocate(self, start=1):
+        "Reserve and return a free UID."
+        uid = self.nextFree(start)
+        self.reserve(uid)
+        return uid
+
+
+def iterateArchive(path):
+    """Yield (name, bytes) for every dialogue xml file in `path`, which is either
+a scripts.aod zip archive or a directory with the dialogues unpacked."""
+    if os.path.isdir(path):
+        for dirpath, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.xml'):
+                    fullname = os.path.join(dirpath, filename)
+                    with open(fullname, 'rb') as f:
+                        yield fullname, f.read()
+    else:
+        import zipfile
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if '/dialogues/' in name and name.lower().endswith('.xml'):
+                    yield name, archive.read(name)
+
+def readArchiveUIDs(path):
+    """Map each dialogue in the archive at `path` to the set of its UIDs.  Returns
+that map and a list of "name: error" for the dialogues that couldn't be read
+(and whose UIDs are therefore missing)."""
+    rv = {}
+    skipped = []
+    for name, data in iterateArchive(path):
+        try:
+            rv[name] = set(part.UID for part in readDialogue(io.BytesIO(data)).parts)
+        except BadXmlException as e:
+            skipped.append('%s: %s' % (name, e))
+    return rv, skipped
+
+class DialogueSnapshot:
+    """Plain-data summary of a `Dialogue`, keyed by UID.  Used to tell which
+nodes changed on disk without touching the tree widget."""
+    def __init__(self, dialogue):
+        self.roots = tuple(dialogue.roots)
+        self.header = (dialogue.dialogueName,
+                       dialogue.defaultSpeakerName,
+                       dialogue.defaultPortrait,
+                       tuple(dialogue.conditions))
+        self.parts = {}
+        for part in dialogue.parts:
+            fields = (part.text, part.portrait, part.speakerName, '\n'.join(part.scripts))
+            answers = tuple((answer.text,
+                             answer.condition,
+                             '\n'.join(answer.scripts),
+                             tuple(answer.allLinks()))
+                            for answer in part.answers)
+            self.parts.setdefault(part.UID, (fields, answers))
+    def reachable(self):
+        "UIDs of the parts reachable from the roots, i.e. the ones the editor shows."
+        seen = set(uid for uid in self.roots if uid in self.parts)
+        todo = list(seen)
+        while todo:
+            for answer in self.parts[todo.pop()][1]:
+                for (uid, _) in answer[3]:
+                    if uid not in seen and uid in self.parts:
+                        seen.add(uid)
+                        todo.append(uid)
+        return seen
+
+def layeredLayout(roots, edges, previous=None, sweeps=4):
+    """Sugiyama-style layered layout of the dialogue graph.
+
+`roots` are the entry node UIDs, `edges` maps every node UID to the UIDs it
+links to.  Layers are BFS depths from the roots, so links back to earlier nodes
+don't push anything down; nodes within a layer are ordered by the barycenter
+heuristic.  `previous` is the (layout, edges) pair of an earlier run: it seeds
+the ordering, and only layers touched by changed nodes get reordered, so small
+edits move few nodes.  Returns {uid: (layer, position)}."""
+    layer = {}
+    discovered = []
+    for start in list(roots) + list(edges):
+        if start in layer or start not in edges:
+            continue
+        layer[start] = 0
+        discovered.append(start)
+        queue = deque([start])
+        while queue:
+            uid = queue.popleft()
+            for target in edges.get(uid, ()):
+                if target not in layer and target in edges:
+                    layer[target] = layer[uid] + 1
+                    discovered.append(target)
+                    queue.append(target)
+    layers = [[] for _ in range(max(layer.values(), default=-1) + 1)]
+    for uid in discovered:
+        layers[layer[uid]].append(uid)
+    previousLayout, previousEdges = previous or ({}, {})
+    previousOrder = {uid: position for (uid, (_, position)) in previousLayout.items()}
+    discoveryIndex = {uid: i for (i, uid) in enumerate(discovered)}
+    position = {}
+    for nodes in layers:
+        nodes.sort(key=lambda uid: (0, previousOrder[uid]) if uid in previousOrder else (1, discoveryIndex[uid]))
+        position.update((uid, i) for (i, uid) in enumerate(nodes))
+
+    # only edges between adjacent layers take part in the crossing reduction
+    predecessors = {uid: [] for uid in layer}
+    successors = {uid: [] for uid in layer}
+    for (uid, targets) in edges.items():
+        for target in targets:
+            if target in layer and layer[target] == layer[uid] + 1:
+                predecessors[target].append(uid)
+                successors[uid].append(target)
+    def reorder(nodes, neighbours):
+        def barycenter(uid):
+            adjacent = neighbours[uid]
+            if not adjacent:
+                return position[uid]
+            return sum(position[n] for n in adjacent) / len(adjacent)
+        nodes.sort(key=barycenter)
+        position.update((uid, i) for (i, uid) in enumerate(nodes))
+    if previous:
+        changed = [uid for uid in layer
+                   if previousLayout.get(uid, (None,))[0] != layer[uid] or previousEdges.get(uid) != edges[uid]]
+        dirty = set()
+        for uid in changed:
+            dirty.add(layer[uid])
+            dirty.update(layer[n] for n in successors[uid] + predecessors[uid])
+    else:
+        dirty = set(range(len(layers)))
+    for sweep in range(sweeps):
+        if sweep % 2 == 0:
+            for i in range(1, len(layers)):
+                if i in dirty:
+                    reorder(layers[i], predecessors)
+        else:
+            for i in range(len(layers) - 2, -1, -1):
+                if i in dirty:
+                    reorder(layers[i], successors)
+    return {uid: (layer[uid], position[uid]) for uid in layer}
+
+def main(argv):
+    "Command line: report malformed dialogues and UID collisions."
+    import argparse
+    parser = argparse.ArgumentParser(description='Check Age of Decadence dialogue files.')
+    parser.add_argument('--archive', help='scripts.aod (or an unpacked directory) to check UIDs against')
+    parser.add_argument('files', nargs='+', help='dialogue xml files')
+    args = parser.parse_args(argv)
+    archive, skipped = readArchiveUIDs(args.archive) if args.archive else ({}, [])
+    for message in skipped:
+        print('skipped %s; its UIDs are not checked' % message)
+    problems = len(skipped)
+    dialogues = {}
+    for filename in args.files:
+        try:
+            dialogues[filename] = readDialogue(filename)
+        except (BadXmlException, OSError) as e:
+            print('%s: %s' % (filename, e))
+            problems += 1
+    for (filename, dialogue) in dialogues.items():
+        # the archive copy of a file being checked doesn't count as a collision
+        others = {name: uids for (name, uids) in archive.items()
+                  if os.path.basename(name).lower() != os.path.basename(filename).lower()}
+        for (name, other) in dialogues.items():
+            if name != filename:
+                others[name] = set(part.UID for part in other.parts)
+        uids = UIDAllocator()
+        for part in dialogue.parts:
+            if not uids.reserve(part.UID):
+                print('%s: line %d: UID %d is used by more than one node' % (filename, part.line, part.UID))
+                problems += 1
+            for (name, other) in others.items():
+                if part.UID in other:
+                    print('%s: line %d: UID %d is also used by %s' % (filename, part.line, part.UID, name))
+                    problems += 1
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -12,19 +12,56 @@ website: zetcode.com
 last edited: January 2015
 """
 import sys
+import os
+import io
 import functools
 import types
-import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+import importlib.util
 from itertools import zip_longest, count
+from collections import Counter
 import re
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-from PyQt5 import uic
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QFileSystemWatcher, QTimer, QThread, QRectF, QPointF, pyqtSignal
+
+from dialogue import BadXmlException, readDialogue, UIDAllocator, readArchiveUIDs, DialogueSnapshot, layeredLayout
+
+UI_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__uicache__')
+_uiClasses = {}
+
+def loadUi(filename, widget):
+    """Set up `widget` from the Qt Designer file `filename`, like `uic.loadUi`.
+The .ui file is compiled into a Python module in `UI_CACHE_DIR` on first use and
+whenever it is newer than that module; otherwise the module is just imported."""
+    uiFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    key = (uiFile, os.path.getmtime(uiFile))
+    if key not in _uiClasses:
+        pyFile = os.path.join(UI_CACHE_DIR, os.path.splitext(filename)[0] + '_ui.py')
+        try:
+            if not os.path.exists(pyFile) or os.path.getmtime(pyFile) < key[1]:
+                from PyQt5 import uic
+                os.makedirs(UI_CACHE_DIR, exist_ok=True)
+                with open(pyFile + '.tmp', 'w', encoding='utf-8') as f:
+                    uic.compileUi(uiFile, f)
+                os.replace(pyFile + '.tmp', pyFile)
+        except OSError:
+            # read-only install: fall back to parsing the .ui file every time
+            from PyQt5 import uic
+            return uic.loadUi(uiFile, widget)
+        spec = importlib.util.spec_from_file_location(os.path.basename(pyFile)[:-3], pyFile)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _uiClasses[key] = next(value for (name, value) in vars(module).items() if name.startswith('Ui_'))
+    ui = _uiClasses[key]()
+    ui.setupUi(widget)
+    # uic.loadUi puts the child widgets on the widget itself
+    for (name, value) in vars(ui).items():
+        setattr(widget, name, value)
+    return widget
 
 def _el(name, text):
+    import xml.etree.ElementTree as ET
     el = ET.Element(name)
     el.text = text
     return el
@@ -76,6 +113,7 @@ class NPCItem(QTreeWidgetItem, AutoProperty):
     def deref(self):
         return self
     def toXmlPart(self, children):
+        import xml.etree.ElementTree as ET
         dlgPart = ET.Element('dlgPart')
         def sub(name, eltName=None):
             tosave = getattr(self, name)
@@ -259,26 +297,180 @@ class ConditionalLink(QTreeWidgetItem, AutoProperty):
                 self.link = value
         super().setData(column, role, value)
 
-class BadXmlException(BaseException):
-    pass
-
-# class MalformedDialogue(BaseException):
-#     def __init__(self):
-#         super().__init__()
-
-def subtext(element, xpath):
-    "`element.find(xpath).text`, or '' if no such xpath"
-    subelement = element.find(xpath)
-    if subelement is None:
-        return ""
-    else:
-        return subelement.text
+class LayoutWorker(QThread):
+    "Runs `layeredLayout` off the GUI thread.  Only plain data crosses threads."
+    done = pyqtSignal(int, object)
+    def __init__(self, generation, roots, edges, previous):
+        super().__init__()
+        self.generation = generation
+        self.args = (roots, edges, previous)
+    def run(self):
+        self.done.emit(self.generation, layeredLayout(*self.args))
+
+class GraphNodeItem(QGraphicsItem):
+    "An NPC node in the graph view.  Drawn with less detail the further out we zoom."
+    WIDTH = 180
+    HEIGHT = 48
+    def __init__(self, node):
+        super().__init__()
+        self.node = node
+        self.label = None
+        self.setFlag(QGraphicsItem.ItemIsSelectable)
+    def boundingRect(self):
+        return QRectF(-self.WIDTH / 2, -self.HEIGHT / 2, self.WIDTH, self.HEIGHT)
+    def invalidate(self):
+        "The node's text changed."
+        self.label = None
+        self.update()
+    def paint(self, painter, option, widget=None):
+        rect = self.boundingRect()
+        color = QColor(255, 220, 120) if self.isSelected() else QColor(200, 215, 255)
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+        if lod < 0.3:
+            painter.fillRect(rect, color)
+            return
+        painter.setPen(QPen(QColor(0, 0, 255), 0))
+        painter.setBrush(color)
+        painter.drawRect(rect)
+        if lod < 0.6:
+            return
+        if self.label is None:
+            text = '%s: %s' % (self.node.UID, self.node.data(0, Qt.DisplayRole))
+            self.label = QFontMetrics(painter.font()).elidedText(text, Qt.ElideRight, 2 * (self.WIDTH - 8))
+        painter.setPen(QColor(0, 0, 0))
+        painter.drawText(rect.adjusted(4, 2, -4, -2), Qt.AlignLeft | Qt.AlignVCenter | Qt.TextWordWrap, self.label)
+
+class DialogueGraphView(QGraphicsView):
+    """The dialogue as a graph of NPC nodes, one edge per answer link.  Unlike the
+tree, shared nodes appear only once.  Layout runs on a `LayoutWorker`."""
+    nodeActivated = pyqtSignal(int)
+    XSPACING = 200
+    YSPACING = 110
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setScene(QGraphicsScene(self))
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setOptimizationFlags(QGraphicsView.DontSavePainterState | QGraphicsView.DontAdjustForAntialiasing)
+        self.nodeItems = {}
+        self.edgeItems = []
+        self.edges = {}
+        self.layout = {}
+        self.generation = 0
+        self.worker = None
+        self.layoutInput = None
+        self.pending = None
+        self.syncing = False
+        self.scene().selectionChanged.connect(self.onSelectionChanged)
+    def setGraph(self, roots, edges, nodes):
+        "Lay out the graph given by `roots`, `edges` and `nodes` ({uid: NPCItem})."
+        self.generation += 1
+        self.pending = (self.generation, roots, edges, nodes)
+        if self.worker is None:
+            self.startPending()
+    def startPending(self):
+        generation, roots, edges, nodes = self.pending
+        self.pending = None
+        self.layoutInput = (edges, nodes)
+        self.worker = LayoutWorker(generation, roots, edges, (self.layout, self.edges) if self.layout else None)
+        self.worker.done.connect(self.applyLayout)
+        self.worker.finished.connect(self.onWorkerFinished)
+        self.worker.start()
+    def onWorkerFinished(self):
+        if self.worker is None:
+            return # already waited for in stopLayout
+        # `finished` comes just before the thread has really ended
+        self.worker.wait()
+        self.worker = None
+        if self.pending:
+            self.startPending()
+    def stopLayout(self):
+        "Drop queued layouts and wait for the running one, before the view goes away."
+        self.pending = None
+        if self.worker is not None:
+            self.worker.wait()
+            self.worker = None
+    def applyLayout(self, generation, layout):
+        if generation != self.generation:
+            return # a newer graph is already being laid out
+        edges, nodes = self.layoutInput
+        self.syncing = True
+        for uid in list(self.nodeItems):
+            if uid not in layout or self.nodeItems[uid].node is not nodes.get(uid):
+                self.scene().removeItem(self.nodeItems.pop(uid))
+        layerSizes = Counter(layer for (layer, _) in layout.values())
+        positions = {}
+        for (uid, (layer, position)) in layout.items():
+            item = self.nodeItems.get(uid)
+            if item is None:
+                item = self.nodeItems[uid] = GraphNodeItem(nodes[uid])
+                self.scene().addItem(item)
+            positions[uid] = QPointF((position - (layerSizes[layer] - 1) / 2) * self.XSPACING,
+                                     layer * self.YSPACING)
+            item.setPos(positions[uid])
+        self.layout = layout
+        self.edges = edges
+        self.drawEdges(layout, positions)
+        self.syncing = False
+    def drawEdges(self, layout, positions):
+        "Edges go into one path per layer, which keeps the scene small but still culls well."
+        for item in self.edgeItems:
+            self.scene().removeItem(item)
+        self.edgeItems = []
+        half = GraphNodeItem.HEIGHT / 2
+        forward = {}
+        backward = QPainterPath()
+        for (uid, targets) in self.edges.items():
+            if uid not in positions:
+                continue
+            start = positions[uid]
+            for target in targets:
+                if target not in positions:
+                    continue
+                end = positions[target]
+                if layout[target][0] > layout[uid][0]:
+                    path = forward.setdefault(layout[uid][0], QPainterPath())
+                    path.moveTo(start.x(), start.y() + half)
+                    path.lineTo(end.x(), end.y() - half)
+                else:
+                    backward.moveTo(start.x() + GraphNodeItem.WIDTH / 2, start.y())
+                    backward.cubicTo(start.x() + GraphNodeItem.WIDTH, start.y(),
+                                     end.x() + GraphNodeItem.WIDTH, end.y(),
+                                     end.x() + GraphNodeItem.WIDTH / 2, end.y())
+        for path in forward.values():
+            self.edgeItems.append(self.scene().addPath(path, QPen(QColor(70, 70, 70), 0)))
+        self.edgeItems.append(self.scene().addPath(backward, QPen(QColor(150, 150, 150), 0, Qt.DashLine)))
+        for item in self.edgeItems:
+            item.setZValue(-1)
+    def updateNode(self, uid):
+        "Repaint the node `uid` after its text changed."
+        if uid in self.nodeItems:
+            self.nodeItems[uid].invalidate()
+    def selectNode(self, uid):
+        "Select the node `uid` without emitting `nodeActivated`."
+        self.syncing = True
+        self.scene().clearSelection()
+        item = self.nodeItems.get(uid)
+        if item:
+            item.setSelected(True)
+            self.ensureVisible(item)
+        self.syncing = False
+    def onSelectionChanged(self):
+        if self.syncing:
+            return
+        selected = self.scene().selectedItems()
+        if selected:
+            self.nodeActivated.emit(selected[0].node.UID)
+    def wheelEvent(self, event):
+        factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+        self.scale(factor, factor)
 
 class NodeSelectDialog(QDialog):
     "Selects NPCItem nodes from the current tree."
     def __init__(self):
         super().__init__()
-        uic.loadUi('select_node.ui', self)
+        loadUi('select_node.ui', self)
     def exec(self):
         if super().exec():
             return self.nodes.currentItem().node
@@ -296,8 +488,12 @@ class NodeSelectDialog(QDialog):
         return dialog.exec()
 
 class EditorMainWindow(QMainWindow):
+    closing = pyqtSignal()
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+    def closeEvent(self, event):
+        self.closing.emit()
+        super().closeEvent(event)
 
 class Header(AutoProperty):
     attrNames = ['defaultLink', 'dialogueName', 'defaultSpeakerName', 'defaultPortrait']
@@ -309,6 +505,7 @@ class Header(AutoProperty):
         for attrName in self.attrNames:
             setattr(self, attrName, '')
     def toXmlHeader(self, conditionsWidget):
+        import xml.etree.ElementTree as ET
         header = ET.Element('header')
 
         conditions = ET.SubElement(header, 'conditions')
@@ -316,12 +513,21 @@ class Header(AutoProperty):
         it = QTreeWidgetItemIterator(conditionsWidget, QTreeWidgetItemIterator.All)
         while it.value():
             item = it.value()
-            ET.SubElement(links, "int").text = item.link
-            ET.SubElement(conditions, "string").text = item.condition
             it += 1
+            link = str(item.link or '').strip()
+            if not link and not item.condition:
+                continue # an empty row, e.g. just added
+            if not link.isdigit():
+                raise BaseException('Header condition "%s" needs a node UID to link to, not "%s"' %
+                                    (item.condition or '', link))
+            ET.SubElement(links, "int").text = link
+            ET.SubElement(conditions, "string").text = item.condition
 
+        defaultLink = str(self.defaultLink or '').strip()
+        if defaultLink and not defaultLink.isdigit():
+            raise BaseException('The starting node UID must be a number, not "%s"' % defaultLink)
         ET.SubElement(header, 'dlg_name').text = self.dialogueName
-        ET.SubElement(header, 'def_link').text = self.defaultLink
+        ET.SubElement(header, 'def_link').text = defaultLink
         ET.SubElement(header, 'def_speaker_name').text = self.defaultSpeakerName
         ET.SubElement(header, 'def_portrait').text = self.defaultPortrait
 
@@ -330,23 +536,47 @@ class Header(AutoProperty):
 class Editor:
     def __init__(self, filename=None):
         self.header = Header()
-        self.ui = uic.loadUi('main.ui', EditorMainWindow())
+        self.ui = loadUi('main.ui', EditorMainWindow())
         self.ui.splitter.setSizes([500, 1])
         self.currentFile = None
+        self.archive = {}
+        self.uids = UIDAllocator()
+        self.snapshot = None
+        self.reloading = False
+        self.watcher = QFileSystemWatcher()
+        self.watcher.fileChanged.connect(lambda *_: self.reloadTimer.start())
+        # editors and build scripts often write a file in several steps
+        self.reloadTimer = QTimer()
+        self.reloadTimer.setSingleShot(True)
+        self.reloadTimer.setInterval(300)
+        self.reloadTimer.timeout.connect(self.reloadChangedFile)
+        self.graph = DialogueGraphView()
+        self.graphCanonical = {}
+        self.graph.nodeActivated.connect(self.UI_SelectGraphNode)
+        self.ui.closing.connect(self.graph.stopLayout)
+        self.graphDock = QDockWidget('Dialogue graph', self.ui)
+        self.graphDock.setObjectName('graphDock')
+        self.graphDock.setWidget(self.graph)
+        self.ui.addDockWidget(Qt.RightDockWidgetArea, self.graphDock)
+        self.graphDock.hide()
+        # batch up edits; the graph is only laid out while it's visible
+        self.graphTimer = QTimer()
+        self.graphTimer.setSingleShot(True)
+        self.graphTimer.setInterval(200)
+        self.graphTimer.timeout.connect(self.updateGraph)
+        self.graphDock.visibilityChanged.connect(lambda visible: visible and self.graphTimer.start())
         # self.ui.splitter.splitterMoved.connect(lambda *x: print(*x))
         def onSelect():
             item = self.ui.tree.currentItem()
             if item:
                 self.rebindAll()
+                self.syncGraphSelection(item)
         self.ui.tree.itemSelectionChanged.connect(onSelect)
         self.wireUpDialogueTree()
         self.wireUpActions()
         self.bindHeader()
         if filename:
-            xml = ET.parse(filename)
-            self.populateTree(xml.getroot())
-            self.fillHeader(xml.getroot())
-            self.currentFile = filename
+            self.loadFile(filename)
 
     def rebindAll(self):
         allFields = set(['portrait', 'speakerName', 'text', 'script', 'condition', 'UID'])
@@ -375,19 +605,15 @@ class Editor:
         self.bind(self.ui.defaultSpeakerName, self.header, 'defaultSpeakerName')
         self.bind(self.ui.defaultLink, self.header, 'defaultLink')
 
-    def fillHeader(self, xml):
-        header = xml.find('./header')
-        self.header.defaultPortrait = header.find('./def_portrait').text
-        self.header.defaultLink = header.find('./def_link').text
-        self.header.defaultSpeakerName = header.find('./def_speaker_name').text
-        self.header.dialogueName = header.find('./dlg_name').text
+    def fillHeader(self, dialogue):
+        self.header.defaultPortrait = dialogue.defaultPortrait
+        self.header.defaultLink = dialogue.defaultLink
+        self.header.defaultSpeakerName = dialogue.defaultSpeakerName
+        self.header.dialogueName = dialogue.dialogueName
         self.bindHeader()
-        conditions = [e.text for e in header.find('./conditions')]
-        links = [e.text for e in header.find('./links')]
         # self.ui.headerConditions.setRowCount(max(len(conditions), len(links)))
         self.ui.headerConditions.clear()
-        for (cond, link) in zip_longest(conditions, links):
-            print(cond, link)
+        for (cond, link) in zip_longest(dialogue.conditions, dialogue.links):
             item = ConditionalLink(cond, link)
             self.ui.headerConditions.addTopLevelItem(item)
         self.ui.headerConditions.resizeColumnToContents(0)
@@ -399,6 +625,7 @@ class Editor:
                                        condition=reference.getProperty('condition'))
             reference.emitDataChanged()
             self.rebindAll()
+            self.graphTimer.start()
 
     def UI_AddAnswer(self, parent):
         answer = AnswerItem('<text>')
@@ -408,9 +635,10 @@ class Editor:
         self.ui.text.selectAll()
 
     def UI_AddAnswerLink(self, parent):
-        npcItem = NPCItem(9999, '<text>')
+        npcItem = NPCItem(self.newUID(), '<text>')
         link = AnswerLink(npcItem)
         parent.addChild(link)
+        self.graphTimer.start()
         self.ui.tree.setCurrentItem(link)
         self.ui.text.setFocus()
         self.ui.text.selectAll()
@@ -419,14 +647,24 @@ class Editor:
         "UI action 'remove this node'"
         parent = node.parent()
         parent.removeChild(node)
+        self.graphTimer.start()
 
     def UI_AddReference(self, node):
         target = NodeSelectDialog.selectNode(self)
         if target:
             reference = ReferenceItem(AnswerLink(target))
             node.addChild(reference)
+            self.graphTimer.start()
             self.ui.tree.setCurrentItem(reference)
 
+    def UI_SelectGraphNode(self, uid):
+        "UI action 'node picked in the graph view'"
+        item = self.graphCanonical.get(uid)
+        if (item is None or item.treeWidget() is None) and uid in self.graph.nodeItems:
+            item = self.findCanonical(self.graph.nodeItems[uid].node)
+        if item:
+            self.ui.tree.setCurrentItem(item)
+
     def UI_FollowReference(self, reference):
         canonical = self.findCanonical(reference.deref())
         self.ui.tree.setCurrentItem(canonical)
@@ -440,22 +678,303 @@ class Editor:
     def UI_New(self):
         "UI action 'New file'"
         self.currentFile = None
+        self.snapshot = None
+        self.watchFile(None)
         self.ui.tree.clear()
         self.ui.headerConditions.clear()
+        self.graphTimer.start()
         print(self.ui.children())
         for child in self.ui.findChildren((QLineEdit, QPlainTextEdit)):
             child.clear()
         self.header = Header()
         self.bindHeader()
+        self.uids = UIDAllocator(shared=self.otherDialoguesUIDs())
 
     def UI_Open(self, *args):
         "UI action 'Open'"
         filename, _ = QFileDialog.getOpenFileName(self.ui, "File...", "", "AoD Dialogue Files (*.xml)")
         if filename:
-            xml = ET.parse(filename)
-            self.populateTree(xml.getroot())
-            self.fillHeader(xml.getroot())
-            self.currentFile = filename
+            self.loadFile(filename)
+
+    def UI_ReserveArchiveUIDs(self):
+        "UI action 'Reserve UIDs used by other dialogues in the game archive'"
+        filename, _ = QFileDialog.getOpenFileName(self.ui, "Game archive...", "", "AoD Scripts Archive (*.aod *.zip)")
+        if filename:
+            self.archive, skipped = readArchiveUIDs(filename)
+            self.uids.shared = self.otherDialoguesUIDs()
+            collisions = ['UID %d is also used by %s' % (uid, self.archiveOwner(uid))
+                          for uid in sorted(set(self.collectUIDs()))
+                          if uid in self.uids.shared]
+            self.reportUIDCollisions(collisions, skipped)
+
+    def loadFile(self, filename):
+        "Load the dialogue xml file `filename` into the editor."
+        try:
+            dialogue = readDialogue(filename)
+        except BadXmlException as e:
+            QMessageBox.warning(self.ui, 'Error!', '%s: %s' % (os.path.basename(filename), e))
+            return
+        self.currentFile = filename
+        self.populateTree(dialogue)
+        self.fillHeader(dialogue)
+        self.snapshot = DialogueSnapshot(dialogue)
+        self.watchFile(filename)
+
+    def watchFile(self, filename):
+        "Watch `filename` (and only it) for changes made outside the editor."
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+        if filename:
+            self.watcher.addPath(filename)
+
+    def reloadChangedFile(self):
+        "Merge external changes of the current file into the tree."
+        filename = self.currentFile
+        if not filename or not os.path.exists(filename):
+            return
+        if self.reloading:
+            # a warning shown while reloading runs the event loop; try again after it
+            self.reloadTimer.start()
+            return
+        self.reloading = True
+        try:
+            self.mergeChangedFile(filename)
+        finally:
+            self.reloading = False
+
+    def mergeChangedFile(self, filename):
+        "The work of `reloadChangedFile`."
+        # files replaced by rename drop out of the watch list
+        if filename not in self.watcher.files():
+            self.watcher.addPath(filename)
+        try:
+            dialogue = readDialogue(filename)
+        except BadXmlException as e:
+            self.ui.statusbar.showMessage('%s changed on disk but could not be read: %s' % (os.path.basename(filename), e))
+            return
+        snapshot = DialogueSnapshot(dialogue)
+        if self.snapshot is None or snapshot.roots != self.snapshot.roots:
+            self.reloadPreservingState(dialogue)
+        else:
+            changed = self.patchTree(self.snapshot, snapshot)
+            if snapshot.header != self.snapshot.header:
+                self.fillHeader(dialogue)
+            shown = set(item.deref().UID for item in self.iterateTreeItems(self.ui.tree)
+                        if isinstance(item.deref(), NPCItem) and not isinstance(item, ReferenceItem))
+            if not snapshot.reachable() <= shown:
+                # patching lost part of the tree; never show less than a fresh load would
+                self.reloadPreservingState(dialogue)
+            self.ui.statusbar.showMessage('Reloaded %s: %d node(s) changed' % (os.path.basename(filename), changed))
+        self.snapshot = snapshot
+
+    def reloadPreservingState(self, dialogue):
+        "Rebuild the whole tree from `dialogue`, keeping the selection and collapsed nodes."
+        collapsed = set()
+        for item in self.iterateTreeItems(self.ui.tree):
+            if isinstance(item.deref(), NPCItem) and not isinstance(item, ReferenceItem) and not item.isExpanded():
+                collapsed.add(item.deref().UID)
+        current = self.ui.tree.currentItem()
+        currentUID = current.deref().UID if current and isinstance(current.deref(), NPCItem) else None
+        self.populateTree(dialogue)
+        self.fillHeader(dialogue)
+        for item in self.iterateTreeItems(self.ui.tree):
+            if not isinstance(item, ReferenceItem) and isinstance(item.deref(), NPCItem):
+                if item.deref().UID in collapsed:
+                    self.ui.tree.collapseItem(item)
+                if item.deref().UID == currentUID:
+                    self.ui.tree.setCurrentItem(item)
+
+    def patchTree(self, old, new):
+        """Apply the differences between snapshots `old` and `new` to the tree.  Only
+nodes whose on-disk data changed are touched, so unsaved edits elsewhere survive.
+Returns the number of changed nodes."""
+        changedFields = [uid for (uid, part) in new.parts.items()
+                         if uid in old.parts and old.parts[uid][0] != part[0]]
+        changedAnswers = [uid for (uid, part) in new.parts.items()
+                          if uid in old.parts and old.parts[uid][1] != part[1]]
+        if not changedFields and not changedAnswers:
+            return 0
+        # one pass over the tree to index it; no items are rebuilt here
+        views = {}
+        canonical = {}
+        for item in self.iterateTreeItems(self.ui.tree):
+            node = item.deref()
+            if isinstance(node, NPCItem):
+                views.setdefault(node.UID, []).append(item)
+                if not isinstance(item, ReferenceItem):
+                    canonical.setdefault(node.UID, item)
+        nodes = {uid: items[0].deref() for (uid, items) in views.items()}
+        collisions = []
+
+        def lookup(uid):
+            "The NPCItem for `uid`, created from the new snapshot if not in the tree."
+            if uid not in nodes:
+                if uid not in old.parts: # unlinked parts of the old file were reserved on load
+                    if not self.uids.reserve(uid):
+                        collisions.append('UID %d was added on disk but is already used in the editor' % uid)
+                    elif self.uids.shared is not None and uid in self.uids.shared:
+                        collisions.append('UID %d is also used by %s' % (uid, self.archiveOwner(uid)))
+                (text, portrait, speakerName, script), answers = new.parts[uid]
+                node = NPCItem(uid, text, portrait, speakerName, script)
+                nodes[uid] = node
+                node.answers = makeAnswers(answers)
+            return nodes[uid]
+        def makeAnswers(answers):
+            return [AnswerItem(text, condition, script,
+                               [AnswerLink(lookup(uid), linkCondition) for (uid, linkCondition) in links])
+                    for (text, condition, script, links) in answers]
+
+        for uid in changedFields:
+            if uid in nodes:
+                node = nodes[uid]
+                node.text, node.portrait, node.speakerName, node.script = new.parts[uid][0]
+                for item in views[uid]:
+                    item.emitDataChanged()
+                self.graph.updateNode(uid)
+        # Only nodes that are in the tree get patched: an earlier patch may have
+        # detached one, which a later patch or rehoming may attach again.  Unlinked
+        # subtrees go in place of a remaining reference, and as rehoming one can
+        # attach a reference to another, this goes on until nothing moves.
+        pending = [uid for uid in changedAnswers if uid in canonical]
+        detached = []
+        while True:
+            uid = next((uid for uid in pending if canonical[uid].treeWidget() is not None), None)
+            if uid is not None:
+                pending.remove(uid)
+                self.patchAnswers(canonical[uid], makeAnswers(new.parts[uid][1]), views, canonical, detached)
+                continue
+            detached = [item for item in detached if item.treeWidget() is None]
+            if not any([self.rehome(item, views) for item in detached]):
+                break
+        if self.ui.tree.currentItem():
+            self.rebindAll()
+        if changedAnswers:
+            self.graphTimer.start()
+        self.reportUIDCollisions(collisions)
+        return len(set(changedFields) | set(changedAnswers))
+
+    def patchAnswers(self, parent, answers, views, canonical, detached):
+        """Replace the answers under the canonical tree item `parent` with `answers`.
+Existing subtrees of linked nodes are moved over rather than rebuilt; the ones
+no longer linked from here are added to `detached`."""
+        for answer in parent.takeChildren():
+            for child in answer.takeChildren():
+                if not isinstance(child, ReferenceItem):
+                    detached.append(child)
+        parent.deref().answers = answers
+        for answer in answers:
+            parent.addChild(answer)
+            for link in answer.links:
+                self.attachLink(answer, link, views, canonical)
+
+    def attachLink(self, answer, link, views, canonical):
+        """Add the tree item for `link` under `answer`: the node's existing subtree if
+it is detached (unlinked by an earlier patch), a reference if the node is shown
+elsewhere, or `link` itself with a new subtree."""
+        uid = link.link.UID
+        item = canonical.get(uid)
+        if item is not None and item.treeWidget() is None:
+            # reuse the detached subtree rather than rebuild it; its answer items
+            # belong to it, so a new AnswerLink couldn't take them
+            self.takeDetached(item, views)
+            item.condition = link.condition
+            answer.addChild(item)
+        elif item is not None:
+            item = ReferenceItem(link)
+            views.setdefault(uid, []).append(item)
+            answer.addChild(item)
+        else:
+            canonical[uid] = link
+            views.setdefault(uid, []).append(link)
+            answer.addChild(link)
+            self.appendNewItems(link, views, canonical)
+
+    def appendNewItems(self, root, views, canonical):
+        "Like `appendItems`, but for nodes that are new to an existing tree."
+        for answer in root.getAnswers():
+            root.addChild(answer)
+            for link in answer.links:
+                self.attachLink(answer, link, views, canonical)
+
+    def takeDetached(self, item, views):
+        """Take the detached canonical `item` from its parent, if it has one, so it can
+be attached elsewhere.  That parent may get attached again later, so a reference
+is left in its place."""
+        answer = item.parent()
+        if answer is not None:
+            ref = ReferenceItem(AnswerLink(item.deref(), item.condition))
+            views.setdefault(item.deref().UID, []).append(ref)
+            answer.insertChild(answer.indexOfChild(item), ref)
+            answer.removeChild(item)
+
+    def rehome(self, item, views):
+        """`item` was the canonical place of its node but got unlinked; move it in place
+of a remaining reference to the same node, if there is one.  Returns whether
+anything was moved."""
+        for ref in views.get(item.deref().UID, []):
+            if isinstance(ref, ReferenceItem) and ref.treeWidget() is not None:
+                parent = ref.parent()
+                index = parent.indexOfChild(ref)
+                self.takeDetached(item, views)
+                item.condition = ref.getProperty('condition')
+                parent.takeChild(index)
+                parent.insertChild(index, item)
+                return True
+        # the node itself is gone, but nodes first shown below it may be linked elsewhere
+        moved = False
+        for i in range(item.childCount()):
+            answer = item.child(i)
+            for j in range(answer.childCount()):
+                child = answer.child(j)
+                if not isinstance(child, ReferenceItem):
+                    moved = self.rehome(child, views) or moved
+        return moved
+
+    def otherDialoguesUIDs(self):
+        "A `UIDAllocator` with the UIDs of all archive dialogues except the current one, or None."
+        if not self.archive:
+            return None
+        current = os.path.basename(self.currentFile or '').lower()
+        return UIDAllocator(uid
+                            for (name, uids) in self.archive.items()
+                            if os.path.basename(name).lower() != current
+                            for uid in uids)
+
+    def archiveOwner(self, uid):
+        "Name of the (other) archive dialogue using `uid`."
+        current = os.path.basename(self.currentFile or '').lower()
+        for (name, uids) in self.archive.items():
+            if uid in uids and os.path.basename(name).lower() != current:
+                return os.path.basename(name)
+        return None
+
+    def newUID(self):
+        """Allocate a UID for a new node.  The search starts at this dialogue's lowest
+UID (or past the archive's highest for an empty dialogue), so new nodes stay in
+the dialogue's own range instead of filling gaps left by other dialogues."""
+        start = self.uids.lowest()
+        if start is None and self.uids.shared is not None:
+            start = (self.uids.shared.highest() or 0) + 1
+        return self.uids.allocate(start or 1)
+
+    def collectUIDs(self):
+        "UIDs of all NPC nodes in the current tree."
+        return [node.UID for node in self.findAllNpcNodes()]
+
+    def reportUIDCollisions(self, collisions, skipped=()):
+        """Warn the user about duplicate UIDs found while loading, and about archive
+dialogues in `skipped` ("name: error") whose UIDs couldn't be reserved."""
+        if not collisions and not skipped:
+            return
+        status = '%d UID collision(s) found' % len(collisions)
+        if skipped:
+            status += ', %d archive dialogue(s) skipped' % len(skipped)
+        self.ui.statusbar.showMessage(status)
+        messages = ['Skipped %s; its UIDs are not reserved' % message for message in skipped] + collisions
+        shown = messages[:20]
+        if len(messages) > len(shown):
+            shown.append('... and %d more' % (len(messages) - len(shown)))
+        QMessageBox.warning(self.ui, 'Duplicate UIDs', '\n'.join(shown))
 
     def UI_Save(self):
         "UI action 'Save'"
@@ -470,6 +989,7 @@ class Editor:
         if filename:
             self.saveFile(filename)
             self.currentFile = filename
+            self.watchFile(filename)
 
     def UI_AddHeaderCondition(self):
         "UI action 'add new header condition'"
@@ -490,16 +1010,24 @@ class Editor:
 
     def saveFile(self, filename):
         "Serialize the current data into xml dialogue format and write it to `filename`"
+        import xml.etree.ElementTree as ET
         try:
             uglyXml = ET.tostring(self.toXml(), encoding='unicode')
         except BaseException as e:
             QMessageBox.information(self.ui, 'Error!', str(e))
             return
+        import xml.dom.minidom as minidom # only needed here, so not imported at startup
         prettyXml = minidom.parseString(uglyXml).toprettyxml(indent = ' '*2)
         f = open(filename, 'wb')
         f.write(prettyXml.encode('utf-8'))
         f.close()
         del f
+        # so that the watcher doesn't treat our own save as an external change
+        try:
+            self.snapshot = DialogueSnapshot(readDialogue(io.BytesIO(prettyXml.encode('utf-8'))))
+        except BadXmlException as e:
+            self.snapshot = None
+            QMessageBox.warning(self.ui, 'Warning', 'Saved, but the file will not load again: %s' % e)
         return prettyXml
 
     def wireUpActions(self):
@@ -508,6 +1036,8 @@ class Editor:
         self.ui.actionOpen   .triggered.connect(self.UI_Open)
         self.ui.actionSave   .triggered.connect(self.UI_Save)
         self.ui.actionSaveAs .triggered.connect(self.UI_SaveAs)
+        self.ui.actionReserveArchiveUIDs.triggered.connect(self.UI_ReserveArchiveUIDs)
+        self.ui.menu_View.addAction(self.graphDock.toggleViewAction())
         self.ui.uidCopyButton.clicked  .connect(self.UI_CopyUID)
 
         # context menu for the dialogue tree widget
@@ -586,6 +1116,9 @@ class Editor:
         """Bind a text editing widget `editWidget` to the property
 obj.attributeName.  One-way binding from widget to object (widget won't be updated if property changes)."""
         signal = editWidget.textChanged if not isinstance(editWidget, QLineEdit) else editWidget.textEdited
+        if attributeName == 'UID':
+            # only take a typed UID once it's complete, not at every keystroke
+            signal = editWidget.editingFinished
         setter = None
         if isinstance(editWidget, QLineEdit):
             setter = editWidget.setText
@@ -604,18 +1137,53 @@ obj.attributeName.  One-way binding from widget to object (widget won't be updat
         setter('' if obj.getProperty(attributeName) is None else str(obj.getProperty(attributeName)))
         # print('binding: %s.%s, %s' % (obj, attributeName, obj.getProperty(attributeName)))
         def notify(*args):
-            obj.setProperty(attributeName, getText())
+            value = getText()
+            if attributeName == 'UID':
+                value = self.checkEditedUID(obj.getProperty('UID'), value)
+                if value is None:
+                    setter(str(obj.getProperty('UID')))
+                    return
+                if value == obj.getProperty('UID'):
+                    return
+            obj.setProperty(attributeName, value)
             for ref in self.findAllReferences(obj.deref()):
                 ref.emitDataChanged()
+            if attributeName == 'UID':
+                self.graphTimer.start()
+            elif isinstance(obj.deref(), NPCItem):
+                self.graph.updateNode(obj.deref().UID)
         signal.connect(notify)
 
+    def checkEditedUID(self, oldUID, newText):
+        """Reserve a UID typed in by hand and return it as an int, or return None
+(with a warning) if it isn't a number or is taken.  An old UID that is in the
+file on disk stays reserved, since other dialogues may link to it; one that
+was only ever used in the editor is released."""
+        try:
+            uid = int(newText)
+        except ValueError:
+            self.ui.statusbar.showMessage('UID must be a number, not %r' % newText)
+            return None
+        if uid == oldUID:
+            return uid
+        if uid in self.uids:
+            self.ui.statusbar.showMessage('UID %d is already in use' % uid)
+            return None
+        self.uids.reserve(uid)
+        if self.snapshot is None or oldUID not in self.snapshot.parts:
+            self.uids.release(oldUID)
+        self.ui.statusbar.clearMessage()
+        return uid
+
     def unbind(self, editWidget):
         "Unbind the given widget from all 'change' signals."
-        signal = editWidget.textChanged if not isinstance(editWidget, QLineEdit) else editWidget.textEdited
-        try:
-            signal.disconnect()
-        except:
-            pass
+        signals = [editWidget.textChanged] if not isinstance(editWidget, QLineEdit) else \
+                  [editWidget.textEdited, editWidget.editingFinished]
+        for signal in signals:
+            try:
+                signal.disconnect()
+            except:
+                pass
 
     def appendItems(self, added, root):
         "Auxiliary: append nodes to given root."
@@ -624,81 +1192,58 @@ obj.attributeName.  One-way binding from widget to object (widget won't be updat
             root.addChild(answer)
             for link in answer.links:
                 assert(isinstance(link.link, NPCItem))
-                if link.link in added:
+                if link.link.UID in added:
                     # print('ALREADY ADDED: [%s]' % link.link.text)
                     answer.addChild(ReferenceItem(link))
                 else:
-                    added.append(link.link)
+                    added.add(link.link.UID)
                     answer.addChild(link)
                     self.appendItems(added, link)
 
-    def populateTree(self, xmlroot):
-        "Populate the UI dialogue tree from given xml root."
+    def populateTree(self, dialogue):
+        "Populate the UI dialogue tree from a `Dialogue` read by `readDialogue`."
         self.ui.tree.clear()
-        added = []
+        self.uids = UIDAllocator(shared=self.otherDialoguesUIDs())
+        collisions = []
+        added = set()
         allItems = []
         uid_to_npc_item = {}
-        xParts = xmlroot.find('./parts')
-        print(xParts, bool(xParts))
-        if xParts is None:
-            raise BadXmlException()
-        xDlgParts = xParts.findall('./dlgPart')
-        # print('xDlgParts: %s, xParts', xDlgParts, xParts)
-        if xDlgParts:
-            for part in xDlgParts:
-                item = NPCItem(subtext(part, './UID'),
-                               subtext(part, './npc_text'),
-                               subtext(part, './portrait'),
-                               subtext(part, './speaker_name'),
-                               '\n'.join(map(lambda x: x.text,
-                                             part.findall('./onLoadScripts/string'))))
-                allItems.append(item)
-                # print('saving %s' % item.UID)
-                uid_to_npc_item[item.UID] = item
-                item.answers = []
-                for xAnswer in part.findall('./answers/dlgAnsw'):
-                    defaultLink = AnswerLink(subtext(xAnswer, './def_link'),
-                                             None)
-                    answer = AnswerItem(subtext(xAnswer, './text'),
-                                        subtext(xAnswer, './checkOnAppear'),
-                                        '\n'.join(map(lambda x: x.text,
-                                                      xAnswer.findall('./scriptsOnClick/string'))),
-                                        [defaultLink])
-                    checksOnClick = xAnswer.findall('./checksOnClick/string')
-                    linksOnClick = xAnswer.findall('./linksOnClick/int')
-                    #scriptsOnClick = xAnswer.findall('./scriptsOnClick/string')
-
-                    for (check, link) in zip_longest(checksOnClick, linksOnClick):
-                        print('appending links, %s, %s' % (link, check))
-                        answer.links.append(AnswerLink(int(link.text),
-                                                       check.text))
-                    item.answers.append(answer)
-        # print('before resolving, allItems: %s', allItems)
-        # resolve answer links
+        for part in dialogue.parts:
+            if not self.uids.reserve(part.UID):
+                collisions.append('UID %d is used by more than one node, only the first one is kept' % part.UID)
+                continue
+            if self.uids.shared is not None and part.UID in self.uids.shared:
+                collisions.append('UID %d is also used by %s' % (part.UID, self.archiveOwner(part.UID)))
+            item = NPCItem(part.UID, part.text, part.portrait, part.speakerName, '\n'.join(part.scripts))
+            allItems.append(item)
+            uid_to_npc_item[item.UID] = item
+            item.answers = []
+            for xAnswer in part.answers:
+                answer = AnswerItem(xAnswer.text, xAnswer.condition, '\n'.join(xAnswer.scripts))
+                for (uid, condition) in xAnswer.allLinks():
+                    answer.links.append(AnswerLink(uid, condition))
+                item.answers.append(answer)
+        # resolve answer links; readDialogue has checked they all exist
         for item in allItems:
             for answer in item.answers:
                 for link in answer.links:
-                    if link.link is not int:
-                        link.link = uid_to_npc_item[int(link.link)]
+                    link.link = uid_to_npc_item[link.link]
 
         # actually populate the tree
-        def_link = subtext(xmlroot, './header/def_link')
-        roots = []
-        if def_link:
-            roots.append(def_link)
-        roots.extend([x.text for x in xmlroot.findall('./header/links/int')])
-        roots = [int(x) for x in roots]
+        roots = set(dialogue.roots)
         for rootItem in [item for item in allItems if item.UID in roots]:
-            # print('rootItem', rootItem)
             self.ui.tree.addTopLevelItem(rootItem)
-            added.append(rootItem)
+            added.add(rootItem.UID)
             self.appendItems(added, rootItem)
         if self.ui.tree.topLevelItemCount() > 0:
             self.ui.tree.setCurrentItem(self.ui.tree.topLevelItem(0))
             self.expandAllItems(self.ui.tree.currentItem())
+        self.graphTimer.start()
+        self.reportUIDCollisions(collisions)
 
     def toXml(self):
         "Convert current dialogue data to ElementTree xml data."
+        import xml.etree.ElementTree as ET
         rootItem = self.ui.tree.invisibleRootItem()
         rootElement = ET.Element('dlgData')
         rootElement.append(self.header.toXmlHeader(self.ui.headerConditions))
@@ -719,6 +1264,46 @@ obj.attributeName.  One-way binding from widget to object (widget won't be updat
                 uids_processed.append(item.deref().UID)
         return rootElement
 
+    def graphData(self):
+        """The dialogue as plain data for the graph view: root UIDs, {uid: [linked uids]},
+{uid: NPCItem} and {uid: canonical tree item}."""
+        roots = []
+        edges = {}
+        nodes = {}
+        canonical = {}
+        for item in self.iterateTreeItems(self.ui.tree):
+            node = item.deref()
+            if not isinstance(node, NPCItem) or isinstance(item, ReferenceItem) or node.UID in canonical:
+                continue
+            if item.parent() is None:
+                roots.append(node.UID)
+            nodes[node.UID] = node
+            canonical[node.UID] = item
+            targets = edges[node.UID] = []
+            for i in range(item.childCount()):
+                answer = item.child(i)
+                for j in range(answer.childCount()):
+                    targets.append(answer.child(j).deref().UID)
+        return roots, edges, nodes, canonical
+
+    def updateGraph(self):
+        "Re-layout the graph view after structural changes."
+        if not self.graphDock.isVisible():
+            return
+        roots, edges, nodes, self.graphCanonical = self.graphData()
+        self.graph.setGraph(roots, edges, nodes)
+        current = self.ui.tree.currentItem()
+        if current:
+            self.syncGraphSelection(current)
+
+    def syncGraphSelection(self, item):
+        "Select the node for tree item `item` in the graph view."
+        node = item.deref()
+        if isinstance(node, AnswerItem) and item.parent():
+            node = item.parent().deref()
+        if isinstance(node, NPCItem) and self.graphDock.isVisible():
+            self.graph.selectNode(node.UID)
+
     def findCanonical(self, npcItem):
         "Find the canonical item representing `npcItem`."
         assert(self.ui.tree)
@@ -763,7 +1348,6 @@ obj.attributeName.  One-way binding from widget to object (widget won't be updat
         while it.value():
             yield it.value()
             it += 1
-        raise StopIteration()
 
 if __name__ == '__main__':
     global app